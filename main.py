@@ -1,17 +1,26 @@
 # File: main.py
 
 import asyncio
+import contextlib
+import heapq
+import logging
+import secrets
+import time
 import uuid
 import random
-from datetime import datetime, timedelta, timezone
+from collections import defaultdict, deque
+from datetime import datetime, timezone
 
-from fastapi import FastAPI, WebSocket, HTTPException, WebSocketDisconnect
+import orjson
+from fastapi import FastAPI, WebSocket, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.websockets import WebSocketState
 from pydantic import BaseModel
-from typing import Dict, List, Any
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
 
 # --- Basic Setup ---
 app = FastAPI()
+logger = logging.getLogger("tempmail")
 
 # --- CORS Configuration ---
 # Allow requests from the frontend (adjust origin if your frontend is on a different port/domain)
@@ -26,100 +35,285 @@ app.add_middleware(
 )
 
 # --- In-Memory "Database" ---
+# How long an inbox lives after creation or its last refresh.
+INBOX_LIFETIME_SECONDS = 3600
+
+# Only the most recent messages are kept; older ones are dropped from the front.
+MAX_MESSAGES_PER_INBOX = 100
+
+
+class Inbox:
+    """
+    A single temporary inbox. Uses __slots__ to keep the per-inbox footprint small.
+    """
+    __slots__ = ("email_address", "messages", "expires_at")
+
+    def __init__(self, email_address: str, expires_at: float):
+        self.email_address = email_address
+        # [{"id": "...", "sender": "...", "subject": "...", "body": "..."}, ...]
+        self.messages: deque = deque(maxlen=MAX_MESSAGES_PER_INBOX)
+        # Unix timestamp (seconds)
+        self.expires_at = expires_at
+
+
 # This dictionary will store all our temporary inboxes.
-# Structure:
-# {
-#   "email_id_1": {
-#     "email_address": "random1@temp.com",
-#     "messages": [{"sender": "...", "subject": "...", "body": "..."}],
-#     "expires_at": datetime_object
-#   },
-#   ...
-# }
-inboxes: Dict[str, Dict[str, Any]] = {}
+# Structure: { "email_id": Inbox_object }
+inboxes: Dict[str, Inbox] = {}
+
+# Reverse index of every email address currently in use, for O(1) duplicate checks.
+used_addresses: set[str] = set()
+
+# Min-heap of (expires_at, email_id) pairs so cleanup only touches inboxes that are due.
+# Each inbox has one entry; a refreshed inbox's entry is re-pushed with its new expiry when
+# it comes due, and a deleted inbox's entry is skipped when popped.
+expiry_heap: List[Tuple[float, str]] = []
+
+# Maximum number of inboxes expired before the cleanup job yields to the event loop,
+# so a burst of simultaneous expiries doesn't stall WebSocket pushes.
+CLEANUP_BATCH_SIZE = 32
+
+# Dense list of active inbox IDs (plus each ID's position in it) so the simulator
+# can pick a random inbox without copying every key.
+inbox_ids: List[str] = []
+inbox_id_to_index: Dict[str, int] = {}
 
 # This dictionary will manage active WebSocket connections.
-# Structure: { "email_id": WebSocket_object }
-active_connections: Dict[str, WebSocket] = {}
+# Several clients (tabs, devices) may listen on the same inbox at once. Each connection
+# has its own bounded outgoing queue drained by a dedicated sender task, so a slow
+# client never blocks the simulator or other clients.
+# Structure: { "email_id": {WebSocket_object: asyncio.Queue, ...} }
+active_connections: Dict[str, Dict[WebSocket, asyncio.Queue]] = defaultdict(dict)
+
+# Maximum number of pending pushes per connection; the oldest is dropped when full.
+SEND_QUEUE_SIZE = 64
+
+# Queued in place of a payload to make a connection's sender task close its WebSocket.
+CLOSE_CONNECTION = None
+
+# --- Simulated Email Templates ---
+# The static parts of each simulated email, formatted once per message.
+EMAIL_BODY_TEMPLATE = (
+    "This is a simulated email body for {addr}. \n\n"
+    "Timestamp: {ts}.\n\n"
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit. Sed non risus."
+)
+format_sender = "service-{}@example.com".format
+format_subject = "Important Notification #{}".format
 
-# --- Pydantic Models for Request Bodies ---
+# Dedicated random generator for the simulator, kept separate from the shared module-level one.
+simulation_rng = random.Random()
+
+# --- Pydantic Models for Request and Response Bodies ---
 class EmailRequest(BaseModel):
     email_id: str
 
+
+class EmailMessage(BaseModel):
+    id: str
+    sender: str
+    subject: str
+    body: str
+
+
+class InboxResponse(BaseModel):
+    inbox: List[EmailMessage]
+
 # --- Helper Functions & Background Tasks ---
 
-async def cleanup_expired_inboxes():
+def discard_connection(email_id: str, websocket: WebSocket):
     """
-    A background task that runs periodically to remove expired inboxes.
+    Removes a single WebSocket from an inbox's subscribers, dropping the entry once it is empty.
     """
-    while True:
-        # Wait for 60 seconds before the next cleanup
-        await asyncio.sleep(60)
-        now = datetime.now(timezone.utc)
-        
-        # Find which inboxes have expired
-        expired_ids = [
-            email_id for email_id, data in inboxes.items() 
-            if data["expires_at"] < now
-        ]
-        
-        # Safely delete the expired inboxes and close any related connections
-        for email_id in expired_ids:
-            print(f"INFO: Deleting expired inbox for {inboxes[email_id]['email_address']}")
-            if email_id in inboxes:
-                del inboxes[email_id]
-            if email_id in active_connections:
-                # We can't guarantee a clean close, but we can remove it
-                del active_connections[email_id]
+    connections = active_connections.get(email_id)
+    if connections is None:
+        return
+    connections.pop(websocket, None)
+    if not connections:
+        del active_connections[email_id]
 
 
-async def simulate_email_reception():
+def enqueue_message(queue: asyncio.Queue, payload: Optional[str]):
     """
-    A background task that simulates receiving new emails for active addresses.
+    Queues a payload for a connection without waiting, dropping the oldest pending one if full.
     """
-    while True:
-        # Wait for a random interval (e.g., 10-25 seconds)
-        await asyncio.sleep(random.randint(10, 25))
+    try:
+        queue.put_nowait(payload)
+    except asyncio.QueueFull:
+        queue.get_nowait()
+        queue.put_nowait(payload)
 
-        if not inboxes:
-            continue  # No active inboxes to send emails to
 
-        # Pick a random active inbox
-        target_email_id = random.choice(list(inboxes.keys()))
-        inbox_data = inboxes[target_email_id]
-        
-        # Create a new fake email
-        new_email = {
-            "id": str(uuid.uuid4()),
-            "sender": f"service-{random.randint(100,999)}@example.com",
-            "subject": f"Important Notification #{random.randint(1000, 9999)}",
-            "body": f"This is a simulated email body for {inbox_data['email_address']}. \n\nTimestamp: {datetime.now(timezone.utc).isoformat()}.\n\nLorem ipsum dolor sit amet, consectetur adipiscing elit. Sed non risus."
-        }
-        
-        # Add the email to the in-memory inbox
-        inbox_data["messages"].append(new_email)
-        print(f"INFO: New email for {inbox_data['email_address']}")
+async def close_connection(websocket: WebSocket):
+    """
+    Closes a WebSocket, ignoring errors from connections that are already gone.
+    """
+    try:
+        await websocket.close()
+    except Exception:
+        # Connection might already be closed
+        pass
 
-        # If there's an active WebSocket connection, send the email in real-time
-        if target_email_id in active_connections:
-            connection = active_connections[target_email_id]
-            try:
-                await connection.send_json(new_email)
-                print(f"INFO: Sent email via WebSocket to client for {inbox_data['email_address']}")
-            except WebSocketDisconnect:
-                # The client might have disconnected without a clean close
-                del active_connections[target_email_id]
+
+async def send_queued_messages(email_id: str, websocket: WebSocket, queue: asyncio.Queue):
+    """
+    Drains a connection's outgoing queue onto its WebSocket.
+    Any send failure drops the connection so it can't linger in active_connections.
+    """
+    try:
+        while True:
+            payload = await queue.get()
+            if payload is CLOSE_CONNECTION or websocket.client_state != WebSocketState.CONNECTED:
+                break
+            await websocket.send_text(payload)
+    except Exception:
+        # The client might have disconnected without a clean close, or the network failed
+        pass
+    discard_connection(email_id, websocket)
+    await close_connection(websocket)
+
+
+def add_inbox_id(email_id: str):
+    """
+    Registers an inbox ID in the dense ID list used for random selection.
+    """
+    inbox_id_to_index[email_id] = len(inbox_ids)
+    inbox_ids.append(email_id)
+
+
+def remove_inbox_id(email_id: str):
+    """
+    Removes an inbox ID from the dense ID list in O(1) by swapping it with the last entry.
+    """
+    index = inbox_id_to_index.pop(email_id, None)
+    if index is None:
+        return
+    last_id = inbox_ids.pop()
+    if last_id != email_id:
+        inbox_ids[index] = last_id
+        inbox_id_to_index[last_id] = index
+
+
+async def cleanup_expired_inboxes() -> float:
+    """
+    Removes every inbox whose expiry has passed.
+    Returns when the next cleanup is due, on the event loop's monotonic clock.
+    """
+    now = time.time()
+
+    # Pop only the entries that are actually due
+    processed = 0
+    while expiry_heap and expiry_heap[0][0] < now:
+        processed += 1
+        if processed % CLEANUP_BATCH_SIZE == 0:
+            # Let other tasks run between batches
+            await asyncio.sleep(0)
+
+        expires_at, email_id = heapq.heappop(expiry_heap)
+        data = inboxes.get(email_id)
+        if data is None:
+            # Inbox was deleted since this entry was pushed
+            continue
+        if data.expires_at > expires_at:
+            # Timer was refreshed; reschedule the inbox at its current expiry
+            heapq.heappush(expiry_heap, (data.expires_at, email_id))
+            continue
+
+        logger.info("Deleting expired inbox for %s", data.email_address)
+        used_addresses.discard(data.email_address)
+        remove_inbox_id(email_id)
+        del inboxes[email_id]
+        # Drop any connections still listening on the expired inbox. Their sender tasks
+        # close them, so a slow peer's closing handshake never blocks this job.
+        for queue in active_connections.pop(email_id, {}).values():
+            enqueue_message(queue, CLOSE_CONNECTION)
+
+    # Wake at the earliest pending expiry (or in 60 seconds if nothing is pending).
+    # Expiry is stored as epoch seconds, so convert it to a delay from now.
+    delay = max(expiry_heap[0][0] - time.time(), 0) if expiry_heap else 60
+    return asyncio.get_running_loop().time() + delay
+
+
+async def simulate_email_reception() -> float:
+    """
+    Simulates receiving a new email for a random active address.
+    Returns when the next one is due, on the event loop's monotonic clock.
+    """
+    # Schedule the next email after a random interval (e.g., 10-25 seconds)
+    next_run = asyncio.get_running_loop().time() + simulation_rng.randrange(10, 26)
+
+    if not inboxes:
+        return next_run  # No active inboxes to send emails to
+
+    # Pick a random active inbox
+    target_email_id = inbox_ids[simulation_rng.randrange(len(inbox_ids))]
+    inbox_data = inboxes[target_email_id]
+    
+    # Create a new fake email
+    new_email = {
+        "id": str(uuid.uuid4()),
+        "sender": format_sender(simulation_rng.randrange(100, 1000)),
+        "subject": format_subject(simulation_rng.randrange(1000, 10000)),
+        "body": EMAIL_BODY_TEMPLATE.format(
+            addr=inbox_data.email_address,
+            ts=datetime.now(timezone.utc).isoformat(),
+        ),
+    }
+    
+    # Add the email to the in-memory inbox
+    inbox_data.messages.append(new_email)
+    logger.info("New email for %s", inbox_data.email_address)
+
+    # If there are active WebSocket connections, queue the email for each of them in real-time
+    connections = active_connections.get(target_email_id)
+    if connections:
+        # Serialize once with orjson; sent as a text frame so the browser can JSON.parse it
+        payload = orjson.dumps(new_email).decode()
+        for queue in connections.values():
+            enqueue_message(queue, payload)
+        logger.info("Queued email via WebSocket to %d client(s) for %s", len(connections), inbox_data.email_address)
+
+    return next_run
+
+
+# Delay before a background job that raised is run again.
+JOB_RETRY_DELAY_SECONDS = 60
+
+
+async def run_background_jobs():
+    """
+    A single background task that runs each periodic job when it is due.
+    Jobs are kept in a heap of (wake_at, job_index) pairs; each job returns its next wake time.
+    Wake times use the event loop's monotonic clock so wall-clock changes don't shift them.
+    """
+    loop = asyncio.get_running_loop()
+    jobs: Tuple[Callable[[], Awaitable[float]], ...] = (cleanup_expired_inboxes, simulate_email_reception)
+    # The job index breaks ties between jobs due at the same moment
+    now = loop.time()
+    schedule: List[Tuple[float, int]] = [(now, index) for index in range(len(jobs))]
+    heapq.heapify(schedule)
+
+    while True:
+        wake_at, index = schedule[0]
+        await asyncio.sleep(max(wake_at - loop.time(), 0))
+        try:
+            next_run = await jobs[index]()
+        except Exception:
+            # Keep the other jobs running; retry the failed one later
+            logger.exception("Background job %s failed", jobs[index].__name__)
+            next_run = loop.time() + JOB_RETRY_DELAY_SECONDS
+        heapq.heapreplace(schedule, (next_run, index))
 
 
 # --- FastAPI Startup Event ---
 @app.on_event("startup")
 async def startup_event():
     """
-    On server startup, create the background tasks.
+    On server startup, configure logging and create the background job runner.
     """
-    asyncio.create_task(cleanup_expired_inboxes())
-    asyncio.create_task(simulate_email_reception())
-    print("INFO:     Server startup complete. Background tasks running.")
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    # Keep a reference so the task isn't garbage-collected while running
+    app.state.background_jobs = asyncio.create_task(run_background_jobs())
+    logger.info("Server startup complete. Background jobs running.")
 
 # --- API Endpoints ---
 
@@ -130,38 +324,39 @@ async def generate_new_email():
     """
     # Generate unique identifiers
     email_id = str(uuid.uuid4())
-    random_prefix = uuid.uuid4().hex[:8]
+    random_prefix = secrets.token_hex(4)
     email_address = f"{random_prefix}@temp-inbox.com"
 
     # Ensure no duplicates (highly unlikely, but good practice)
-    while any(d['email_address'] == email_address for d in inboxes.values()):
-        random_prefix = uuid.uuid4().hex[:8]
+    while email_address in used_addresses:
+        random_prefix = secrets.token_hex(4)
         email_address = f"{random_prefix}@temp-inbox.com"
-        
+    used_addresses.add(email_address)
+
     # Set expiration for one hour from now
-    expires_at = datetime.now(timezone.utc) + timedelta(hours=1)
+    expires_at = time.time() + INBOX_LIFETIME_SECONDS
     
     # Store the new inbox
-    inboxes[email_id] = {
-        "email_address": email_address,
-        "messages": [],
-        "expires_at": expires_at
-    }
+    inboxes[email_id] = Inbox(email_address, expires_at)
+    heapq.heappush(expiry_heap, (expires_at, email_id))
+    add_inbox_id(email_id)
     
-    print(f"INFO: Created new email: {email_address} (ID: {email_id})")
+    logger.info("Created new email: %s (ID: %s)", email_address, email_id)
     
     return {"email_id": email_id, "email_address": email_address}
 
 
 @app.get("/api/check_email/{email_id}")
-async def check_email_inbox(email_id: str):
+async def check_email_inbox(email_id: str) -> InboxResponse:
     """
     Returns all emails for a given email_id. Fallback for WebSockets.
     """
-    if email_id not in inboxes:
+    inbox_data = inboxes.get(email_id)
+    if inbox_data is None:
         raise HTTPException(status_code=404, detail="Email ID not found or has expired.")
     
-    return {"inbox": inboxes[email_id]["messages"]}
+    # The declared return type lets FastAPI serialize straight to JSON bytes via Pydantic
+    return InboxResponse(inbox=list(inbox_data.messages))
 
 
 @app.post("/api/delete_email")
@@ -170,22 +365,19 @@ async def delete_email(request: EmailRequest):
     Deletes a temporary email account and its contents.
     """
     email_id = request.email_id
-    if email_id not in inboxes:
+    inbox_data = inboxes.pop(email_id, None)
+    if inbox_data is None:
         raise HTTPException(status_code=404, detail="Email ID not found or has already been deleted.")
         
-    email_address = inboxes[email_id]['email_address']
-    del inboxes[email_id]
+    email_address = inbox_data.email_address
+    used_addresses.discard(email_address)
+    remove_inbox_id(email_id)
     
-    # If a websocket is open for this ID, close it
-    if email_id in active_connections:
-        connection = active_connections.pop(email_id)
-        try:
-            await connection.close()
-        except RuntimeError:
-            # Connection might already be closed
-            pass
+    # If any websockets are open for this ID, close them
+    for connection in active_connections.pop(email_id, {}):
+        await close_connection(connection)
             
-    print(f"INFO: Deleted email: {email_address} (ID: {email_id})")
+    logger.info("Deleted email: %s (ID: %s)", email_address, email_id)
     return {"message": f"Email address {email_address} and its inbox have been deleted."}
 
 
@@ -195,13 +387,16 @@ async def refresh_email_timer(request: EmailRequest):
     Resets the one-hour expiration timer for a given email_id.
     """
     email_id = request.email_id
-    if email_id not in inboxes:
+    inbox_data = inboxes.get(email_id)
+    if inbox_data is None:
         raise HTTPException(status_code=404, detail="Email ID not found or has expired.")
         
-    inboxes[email_id]["expires_at"] = datetime.now(timezone.utc) + timedelta(hours=1)
-    email_address = inboxes[email_id]['email_address']
+    expires_at = time.time() + INBOX_LIFETIME_SECONDS
+    # The expiry heap entry is rescheduled by cleanup when the old expiry comes due
+    inbox_data.expires_at = expires_at
+    email_address = inbox_data.email_address
     
-    print(f"INFO: Refreshed timer for: {email_address} (ID: {email_id})")
+    logger.info("Refreshed timer for: %s (ID: %s)", email_address, email_id)
     return {"message": f"Timer for {email_address} has been reset to one hour."}
 
 
@@ -217,20 +412,28 @@ async def websocket_endpoint(websocket: WebSocket, email_id: str):
         return
 
     await websocket.accept()
-    active_connections[email_id] = websocket
-    print(f"INFO: WebSocket connected for email ID: {email_id}")
+    if email_id not in inboxes:
+        # The inbox was deleted or expired while the handshake was in progress
+        await websocket.close(code=1008) # Policy Violation
+        return
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    active_connections[email_id][websocket] = queue
+    sender_task = asyncio.create_task(send_queued_messages(email_id, websocket, queue))
+    logger.info("WebSocket connected for email ID: %s", email_id)
 
     try:
-        # Keep the connection alive
-        while True:
-            # We don't need to receive anything, just wait for the connection to close.
-            # The server will push messages.
-            await websocket.receive_text()
-    except WebSocketDisconnect:
-        print(f"INFO: WebSocket disconnected for email ID: {email_id}")
+        # Keep the connection alive until the client disconnects. The server only pushes,
+        # so wait on raw ASGI messages rather than decoding inbound frames as text.
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass  # Ignore any stray client frames
+        logger.info("WebSocket disconnected for email ID: %s", email_id)
     finally:
-        # Clean up the connection from our dictionary
-        if email_id in active_connections:
-            del active_connections[email_id]
+        # Stop the sender and clean up the connection from our dictionary
+        sender_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await sender_task
+        discard_connection(email_id, websocket)
 
 # To run this app: uvicorn main:app --reload
+# For production: uvicorn main:app --loop uvloop --http httptools --ws websockets